@@ -1,11 +1,17 @@
 import asyncio
 import logging
 import re
+import time
 import argparse
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+from dataclasses import dataclass
 
 from aiohttp import web
 from aiorcon import RCON
-from jinja2 import Template
 
 # Logger
 logger = logging.getLogger()
@@ -14,10 +20,9 @@ logger.setLevel(logging.INFO)
 # If possible, try to use uvloop for better performance
 try:
     import uvloop
-    uvloop.install()
     logger.info("Using uvloop")
-except Exception:
-    pass
+except ImportError:
+    uvloop = None
 
 # Statistic Mapper
 STATS_MAPPING = {
@@ -31,32 +36,124 @@ STATS_MAPPING = {
     "Map_changes": "Maps",
 }
 
-TEMPLATE_FILE = "response.j2"
+# Regex for the key-value lines of the status command which are exported.
+# The player list below them starts every line with "#", so it never matches.
+STATUS_RE = re.compile(r"^(hostname|players)[ \t]*:[ \t]*(.*?)\s*$",
+                       re.MULTILINE)
+
+# Regex for the value of the "players" line in the status command.
+# There are 3 types of players-patterns
+# "0 humans, 0 bots (16/0 max) (hibernating)" # CSGO
+# "0 (16 max)" # Gmod
+# "12 humans, 0 bots (16 max)" # everything else
+# The first number is always the amount of players, followed
+# by a space. Then there might be the string "humans, "
+# but not for Gmod. Then comes the number of bots, but
+# not for Gmod and than the max_players in brackets.
+# csgo has some special things here where the have a 16/0
+# I currently don't know what the /0 stands for. Maybe STV
+# viewers?
+PLAYERS_RE = re.compile(
+    r"(?P<players>\d+)\s+(humans,\s+)?"
+    r"((?P<bots>\d+)\s+bots\s+)?"
+    r"\((?P<max_players>\d+)(/\d)? max\)"
+)
+
+# The exported metrics as (key in the server_dict, name, type, help).
+# The HELP and TYPE lines and the metric name are joined once here, only the
+# labels and the value are added for each scrape.
+METRICS = tuple(
+    (key, "# HELP %s %s\n# TYPE %s %s\n%s" % (name, help_, name, type_, name))
+    for key, name, type_, help_ in (
+        ("players", "srcds_players", "gauge",
+         "the number of players currently on the server"),
+        ("max_players", "srcds_maxplayers", "gauge",
+         "the maximum number of players on the server"),
+        ("bots", "srcds_bots", "gauge", "the number of bots on the server"),
+        ("CPU", "srcds_cpu", "gauge", "currently unknown"),
+        ("NetIn", "srcds_NetIn", "gauge", "currently unknown"),
+        ("NetOut", "srcds_NetOut", "gauge", "currently unknown"),
+        ("Uptime", "srcds_Uptime", "counter", "server uptime in minutes"),
+        ("Maps", "srcds_Maps", "gauge", "Number of Maps played"),
+        ("FPS", "srcds_FPS", "gauge", "currently unknown"),
+        ("svarms", "srcds_svarms", "gauge",
+         "probably the standard variation of the frametimes in ms"),
+        ("varms", "srcds_varms", "gauge",
+         "probably the variation of the frametimes in ms"),
+        ("vartick", "srcds_vartick", "gauge",
+         "probably the variation of ticks"),
+        # L4D2 has Users and Players in the "stats" command
+        ("Users", "srcds_Users", "gauge", "currently unknown"),
+        # Connects is not known by CSGO but by FoF, HL2DM and TF2
+        ("Connects", "srcds_Connects", "counter",
+         "the number of times someone connected to the server"),
+    )
+)
+
+# Default time in seconds between two queries of a gameserver, this should
+# match the scrape_interval of Prometheus
+POLL_INTERVAL = 15.0
+# Number of polls after which servers are not polled anymore if nobody
+# scraped them in the meantime
+POLL_IDLE_POLLS = 20
+
+# Bodies and headers of the responses which never change
+PLAIN_HEADERS = {"Content-Type": "text/plain; charset=utf-8"}
+# The content type of the Prometheus text exposition format
+METRICS_HEADERS = {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+SERVER_DOWN_BODY = ("# HELP srcds_up is the gameserver reachable\n"
+                    "# TYPE srcds_up gauge\n"
+                    "srcds_up 0").encode("utf-8")
+CONNECTION_REFUSED_BODY = b"Connection refused by target"
 
 
 class TargetSpecificationError(Exception):
     pass
 
 
+@dataclass(frozen=True)
+class Config:
+    """The settings of the exporter as given on the commandline"""
+    port: int = 9591
+    address: str = "127.0.0.1"
+    password: str = None
+    server_address: str = "localhost"
+    server_port: int = 27015
+    workers: int = 1
+    poll_interval: float = POLL_INTERVAL
+
+
 class SRCDSExporter:
 
-    def __init__(self, ip=None, port=None, password=None, single_server=False):
+    def __init__(self, ip=None, port=None, password=None, single_server=False,
+                 poll_interval=POLL_INTERVAL):
 
         self._ip = ip
         self._port = port
         self._password = password
         self._single_server = single_server
+        self._poll_interval = poll_interval
+        self._poll_idle_timeout = POLL_IDLE_POLLS * poll_interval
         # TODO add check that ip, port and password are correct values if
         # single_server is True
 
+        # open RCON connections, keyed by (ip, port, password). Only the
+        # poller of a server uses its connection, so no locking is needed.
+        self._pool = {}
+        # the last result of each server as (server_dict, exception,
+        # traceback of the exception), the
+        # pollers of the servers as (task, future of the first result) and
+        # the time of their last scrape. The poller removes all of them and
+        # the RCON connection of its server when it stops.
+        self._latest = {}
+        self._pollers = {}
+        self._scraped = {}
+
     async def request_handler(self, request):
         """
-        Handler method for aiohttp. Called for each HTTP request.
+        Handler method for aiohttp. Called for each request to /metrics.
         :param request: HTTPRequest Object as given by aiohttp
         """
-        if request.path != "/metrics":
-            return web.Response(text="invalid path", status=404)
-
         # Find the exact target specification
         try:
             ip, port, password = self._get_target(request)
@@ -66,17 +163,19 @@ class SRCDSExporter:
             return web.Response(text="target specification is invalid: %s"
                                 % str(e), status=404)
 
-        # make the RCON queries
+        # get the last result of the RCON queries
         try:
-            status, stats = await self._rcon_query(ip, port, password)
+            server_dict = await self._get_server_dict(ip, port, password)
         except Exception as e:
             if isinstance(e, TimeoutError):
                 logger.info("a timeout error occured during the RCON request.")
                 return self._server_down_response()
             if isinstance(e, ConnectionRefusedError):
+                # TODO improve log message
                 logger.info("Connection was refused by the gameserver")
-                return web.Response(text="Connection refused by target",
-                                    status=503)  # TODO improve log message
+                return web.Response(body=CONNECTION_REFUSED_BODY,
+                                    status=503,
+                                    headers=PLAIN_HEADERS)
             # Add other Exception types here
             # TODO improve log message
             logger.warning("An Exception occured during the following "
@@ -84,58 +183,162 @@ class SRCDSExporter:
             logger.exception(e)
             return self._server_down_response()
 
-        server_dict = {
-            "ip": ip,
-            "port": port,
-            "target": "{%s}:{%s}" % (ip, port)
-        }
-
-        self._parse_query(stats, status, server_dict)
-        return web.Response(text=template.render(**server_dict))
+        body = render_metrics(server_dict).encode("utf-8")
+        return web.Response(body=body, headers=METRICS_HEADERS)
 
     def _server_down_response(self):
         """
         This method returns a response with only the srcds_ip metric as 0
         """
-        resp = ("# HELP srcds_up is the gameserver reachable\n"
-                "# TYPE srcds_up gauge\n"
-                "srcds_up 0")
+        return web.Response(body=SERVER_DOWN_BODY, headers=METRICS_HEADERS)
+
+    async def _get_server_dict(self, ip, port, password):
+        """
+        returns the server_dict of the last query of the server given by ip
+        and port or raises the exception of that query.
+
+        The first scrape of a server starts a poller which queries it every
+        poll interval and waits for its first result. The following
+        scrapes are answered from memory.
+        """
+        key = (ip, port, password)
+        latest = self._latest.get(key)
+        if latest is None:
+            poller = self._pollers.get(key)
+            if poller is None:
+                first = asyncio.get_running_loop().create_future()
+                task = asyncio.ensure_future(
+                        self._poll(ip, port, password, first))
+                poller = self._pollers[key] = (task, first)
+            # a cancelled scrape must not cancel the first result for the
+            # other waiters
+            latest = await asyncio.shield(poller[1])
+        if key in self._pollers:
+            self._scraped[key] = time.monotonic()
+
+        server_dict, error, tb = latest
+        if error is not None:
+            # the same exception is raised by every scrape until the next
+            # poll, starting from the traceback of the poll keeps it from
+            # growing with each of them
+            raise error.with_traceback(tb)
+        return server_dict
+
+    async def _poll(self, ip, port, password, first):
+        """
+        queries the server given by ip and port every poll interval until
+        it was not scraped for POLL_IDLE_POLLS intervals or a query failed.
+
+        :param asyncio.Future first: the future which gets the first result
+        """
+        key = (ip, port, password)
+        self._scraped[key] = time.monotonic()
+        try:
+            while True:
+                latest = await self._poll_once(ip, port, password)
+                if not first.done():
+                    first.set_result(latest)
+                if latest[1] is not None:
+                    # srcds bans addresses after a few failed logins and
+                    # any client can make the exporter poll unreachable
+                    # targets, so failed servers are only queried again by
+                    # the next scrape
+                    break
+                await asyncio.sleep(self._poll_interval)
+                idle = time.monotonic() - self._scraped[key]
+                if idle >= self._poll_idle_timeout:
+                    break
+        finally:
+            if not first.done():
+                first.cancel()
+            del self._pollers[key]
+            self._latest.pop(key, None)
+            self._scraped.pop(key, None)
+            self._drop_connection(key)
+
+    async def _poll_once(self, ip, port, password):
+        """
+        queries the server given by ip and port, parses the answer and
+        stores the result for the following scrapes.
+
+        :returns tuple(dict, Exception, traceback): the server_dict or the
+            exception which occured during the query and its traceback
+        """
+        key = (ip, port, password)
+        try:
+            status, stats = await self._rcon_query(ip, port, password)
+            server_dict = {
+                "ip": ip,
+                "port": port,
+                "target": f"{ip}:{port}",
+            }
+            self._parse_query(stats, status, server_dict)
+            latest = (server_dict, None, None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            latest = (None, e, e.__traceback__)
 
-        return web.Response(text=resp)
+        self._latest[key] = latest
+        return latest
 
     async def _rcon_query(self, ip, port, password):
         """
         queries the server given by ip and port with the stats and status
         commands and returns the answer.
+
+        The RCON connection is kept open and reused for the following
+        queries to the same server. It is only closed if an error occurs,
+        the next query then opens a new one.
         """
-        # this first wait_for is to work around something which is maybe
-        # a bug in aiorcon
-        status = None
-        stats = None
-        rcon = None
+        key = (ip, port, password)
+        rcon = self._pool.get(key)
+        if rcon is not None and not rcon.authenticated:
+            # the gameserver closed the connection since the last query
+            self._drop_connection(key)
+            rcon = None
+
         try:
-            rcon = await asyncio.wait_for(
-                    RCON.create(ip,
-                                port,
-                                password,
-                                # the loop is required due to a
-                                # bug in aiorcon. See
-                                # https://github.com/skmendez/aiorcon/pull/1
-                                loop=asyncio.get_event_loop(),
-                                timeout=1,
-                                auto_reconnect_attempts=2),
-                    2)
             if rcon is None:
-                raise Error
-            print(rcon)
-
-            status = await asyncio.wait_for(rcon("status"), 2)
-            stats = await asyncio.wait_for(rcon("stats"), 2)
-        finally:
-            if rcon is not None:
-                rcon.close()
+                # this first wait_for is to work around something which
+                # is maybe a bug in aiorcon
+                # the loop is required due to a bug in aiorcon. See
+                # https://github.com/skmendez/aiorcon/pull/1
+                rcon = await asyncio.wait_for(
+                        RCON.create(ip,
+                                    port,
+                                    password,
+                                    loop=asyncio.get_running_loop(),
+                                    timeout=1,
+                                    # reconnecting is done by the pool
+                                    auto_reconnect_attempts=0),
+                        2)
+                if rcon is None:
+                    raise Error
+                logger.debug("opened RCON connection to %s:%s", ip, port)
+                self._pool[key] = rcon
+
+            # aiorcon matches the responses to the requests by their id,
+            # so both commands can be in flight on the same connection
+            status, stats = await asyncio.wait_for(
+                    asyncio.gather(rcon("status"), rcon("stats")), 2)
+        except Exception:
+            # the state of the connection is unknown after an error
+            self._drop_connection(key)
+            raise
         return status, stats
 
+    def _drop_connection(self, key):
+        """
+        closes the pooled RCON connection for *key* and removes it from the
+        pool. Does nothing if there is no connection for *key*.
+
+        :param tuple key: the (ip, port, password) of the connection
+        """
+        rcon = self._pool.pop(key, None)
+        if rcon is not None:
+            rcon.close()
+
     def _get_target(self, request):
         """
         returns a tuple of (ip, port, password) which to query depending
@@ -188,24 +391,17 @@ class SRCDSExporter:
 
     def _parse_stats(self, stats, server_dict):
         """
-        Parses the status RCON response and adds the data to *server_dict*
+        Parses the stats RCON response and adds the data to *server_dict*
 
         :param str stats: the output of the *stats* command
         :param dict server_dict: the dict to which the data is added
         """
-        lines = [a.split() for a in stats.splitlines()]
-        names = lines[0]
-        values = lines[1]
-
-        # Replace stats
-        for i, name in enumerate(names):
-            if name in STATS_MAPPING.keys():
-                names[i] = STATS_MAPPING[name]
+        names_line, values_line, *_ = stats.splitlines()
 
-        values = [float(v) for v in values]
-
-        for key, value in zip(names, values):
-            server_dict[key] = value
+        values = map(float, values_line.split())
+        for name, value in zip(names_line.split(), values):
+            # Replace the names of the stats which differ between games
+            server_dict[STATS_MAPPING.get(name, name)] = value
 
     def _parse_status(self, status, server_dict):
         """
@@ -214,95 +410,187 @@ class SRCDSExporter:
         :param str status: the output of the *status* command
         :param dict server_dict: the dict to which the data is added
         """
-        status = status.splitlines()
-        for line in status:
-            # break at the empty line between the key-value pairs and the
-            # players
-            if line.strip() == "":
-                break
-            try:
-                key, value = (a.strip() for a in line.split(":", 1))
-            except ValueError:
-                # FoF has no blank line between the key value
-                # pairs and the player list. This results in a
-                # ValueError.
-                break
-
+        for key, value in STATUS_RE.findall(status):
             if key == "players":
-                # Regex explanation:
-                # There are 3 types of players-patterns
-                # "0 humans, 0 bots (16/0 max) (hibernating)" # CSGO
-                # "0 (16 max)" # Gmod
-                # "12 humans, 0 bots (16 max)" # everything else
-                # The first number is always the amount of players, followed
-                # by a space. Then there might be the string "humans, "
-                # but not for Gmod. Then comes the number of bots, but
-                # not for Gmod and than the max_players in brackets.
-                # csgo has some special things here where the have a 16/0
-                # I currently don't know what the /0 stands for. Maybe STV
-                # viewers?
-
-                m = re.match(
-                    r"(?P<players>\d+)\s+(humans,\s+)?"
-                    r"((?P<bots>\d+)\s+bots\s+)?"
-                    r"\((?P<max_players>\d+)(/\d)? max\)",
-                    value
-                )
-
+                m = PLAYERS_RE.match(value)
                 if m:
-                    for key, value in m.groupdict().items():
-                        server_dict[key] = value
+                    server_dict["players"] = m.group("players")
+                    server_dict["max_players"] = m.group("max_players")
+                    bots = m.group("bots")
+                    if bots is not None:  # Gmod does not list the bots
+                        server_dict["bots"] = bots
 
             elif key == "hostname":  # Hostname
                 server_dict["hostname"] = value
 
 
-# Parse response file
-with open("response.j2", "r") as f:
-    t = f.read()
-    template = Template(t, trim_blocks=True, lstrip_blocks=True,)
+def render_metrics(server_dict):
+    """
+    Renders the *server_dict* in the Prometheus text exposition format.
+    Metrics which are not in the *server_dict* are left out.
+
+    :param dict server_dict: dictionary with metric names and their values
+    :returns str: the metrics of the server
+    """
+    hostname = server_dict.get("hostname", "")
+    hostname = hostname.replace("\\", "\\\\").replace('"', '\\"')
+    labels = '{hostname="%s"} ' % hostname
+
+    blocks = ["# HELP srcds_up is the gameserver reachable\n"
+             "# TYPE srcds_up gauge\n"
+             "srcds_up" + labels + "1\n"]
+    for key, prefix in METRICS:
+        value = server_dict.get(key)
+        if value is not None:
+            blocks.append("%s%s%s\n" % (prefix, labels, value))
+    return "\n".join(blocks)
 
 
-async def start_webserver(loop, args):
+async def start_webserver(config):
     """
     Starts up the server
 
-    :param asyncio.AbstractEventLoop loop: the asyncio event loop to use
-    :param argsparse.Namespace args: the namespace given by argparse
+    :param Config config: the settings of the exporter
+    :returns web.AppRunner: the runner of the started server
     """
 
-    if args.server_address and args.server_port and args.password:
-        exporter = SRCDSExporter(args.server_address,
-                                 args.server_port,
-                                 args.password,
-                                 True)
+    if config.server_address and config.server_port and config.password:
+        exporter = SRCDSExporter(config.server_address,
+                                 config.server_port,
+                                 config.password,
+                                 True,
+                                 poll_interval=config.poll_interval)
     else:  # Not in single server mode
-        exporter = SRCDSExporter(None, None, None)  # TODO add data from parser
+        # TODO add data from parser
+        exporter = SRCDSExporter(None, None, None,
+                                 poll_interval=config.poll_interval)
 
-    server = web.Server(exporter.request_handler)
+    app = web.Application()
+    app.router.add_get("/metrics", exporter.request_handler)
 
-    await loop.create_server(server, args.address, args.port)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # with several workers each of them binds to the same port and the
+    # kernel distributes the connections between them
+    site = web.TCPSite(runner, config.address, config.port,
+                       reuse_port=config.workers != 1)
+    await site.start()
+    return runner
 
 
-if __name__ == "__main__":
-    """Builds the argument parser and starts a server in a asyncio-loop"""
+async def run_webserver(config):
+    """
+    Starts up the server and keeps it running until it is stopped
+
+    :param Config config: the settings of the exporter
+    """
+    runner = await start_webserver(config)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def serve(config):
+    """
+    Runs a server in the current process until it is stopped
+
+    :param Config config: the settings of the exporter
+    """
+    if uvloop is None:
+        asyncio.run(run_webserver(config))
+    elif hasattr(uvloop, "run"):
+        uvloop.run(run_webserver(config))
+    else:
+        # uvloop before 0.18 has no run()
+        uvloop.install()
+        asyncio.run(run_webserver(config))
+
+
+def parse_args():
+    """
+    Builds the argument parser and parses the commandline
+
+    :returns Config: the settings given on the commandline
+    """
     argparser = argparse.ArgumentParser(description=(
             "srcds_exporter, an prometheus exporter for SRCDS based games "
             "like CSGO, L4D2 and TF2"))
-    argparser.add_argument("--port", type=int, default=9591,
+    argparser.add_argument("--port", type=int, default=Config.port,
                            help="the port to which the exporter binds")
-    argparser.add_argument("--address", type=str, default="127.0.0.1",
+    argparser.add_argument("--address", type=str, default=Config.address,
                            help="the address to which the exporter binds")
-    argparser.add_argument("--password", type=str, default=None,
+    argparser.add_argument("--password", type=str, default=Config.password,
                            help="the password that is used if the exporter "
                                 "is run in single server mode")
-    argparser.add_argument("--server_address", type=str, default="localhost",
+    argparser.add_argument("--server_address", type=str,
+                           default=Config.server_address,
                            help="the address which is queried if the is "
                                 "exporter is run in single server mode")
-    argparser.add_argument("--server_port", type=int, default=27015,
+    argparser.add_argument("--server_port", type=int,
+                           default=Config.server_port,
                            help="the queried which is queried if the is "
                                 "exporter is run in single server mode")
+    argparser.add_argument("--workers", type=int, default=Config.workers,
+                           help="the number of worker processes, 0 starts "
+                                "one worker per CPU")
+    argparser.add_argument("--poll_interval", type=float,
+                           default=Config.poll_interval,
+                           help="the time in seconds between two queries of "
+                                "a gameserver, should match the "
+                                "scrape_interval of Prometheus")
     args = argparser.parse_args()
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(start_webserver(loop, args))
-    loop.run_forever()
+    if args.poll_interval <= 0:
+        argparser.error("--poll_interval must be greater than 0")
+    if args.workers < 0:
+        argparser.error("--workers must not be negative")
+    if args.workers == 0:
+        args.workers = os.cpu_count() or 1
+    return Config(**vars(args))
+
+
+def run_workers(config):
+    """
+    Starts the worker processes and waits until one of them exits or the
+    exporter is stopped by SIGTERM or SIGINT. All remaining workers are
+    stopped in both cases.
+
+    :param Config config: the settings of the exporter
+    :returns int: the exit code of the exporter
+    """
+    # the workers get the parsed config instead of parsing it again
+    workers = [multiprocessing.Process(target=serve, args=(config,))
+               for _ in range(config.workers)]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    # installed after starting the workers, so they keep the default handlers
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        multiprocessing.connection.wait([w.sentinel for w in workers])
+        for worker in workers:
+            if not worker.is_alive():
+                logger.error("worker %s exited with code %s, stopping the "
+                             "exporter" % (worker.pid, worker.exitcode))
+        return 1
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    """Parses the commandline and starts the servers in asyncio-loops"""
+    config = parse_args()
+
+    if config.workers == 1:
+        serve(config)
+    else:
+        sys.exit(run_workers(config))
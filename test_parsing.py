@@ -1,5 +1,5 @@
 import unittest
-from main import SRCDSExporter
+from main import SRCDSExporter, render_metrics
 
 class TestParsing(unittest.TestCase):
 
@@ -163,3 +163,51 @@ class TestParsing(unittest.TestCase):
         for key, value in {"CPU": 0, "NetIn": 0, "NetOut": 0, "Uptime": 2,
                            "Maps": 0, "FPS": 66.55, "Players": 0, "Connects": 0}.items():
             self.assertEqual(server_dict[key], value)
+
+    def test_status_with_players(self):
+        data = ("hostname: LinuxGSM\r\n"
+                "version : 1.36.8.7/13687 895/7436 secure  [G:1:2645045]\r\n"
+                "map     : de_mirage\r\n"
+                "players : 2 humans, 1 bots (16/0 max) (not hibernating)\r\n"
+                "\r\n"
+                "# userid name uniqueid connected ping loss state rate adr\r\n"
+                "#  2 1 \"hostname: fake\" STEAM_1:0:123 05:12 40 0 active 786432 192.0.2.2:27005\r\n"
+                "#  3 2 \"players\" STEAM_1:1:456 01:02 60 0 active 786432 192.0.2.3:27005\r\n"
+                "#  4 \"BOT Joe\" BOT active 64\r\n"
+                "#end\r\n")
+        server_dict = {}
+        self.exporter._parse_status(data, server_dict)
+        self.assertEqual(server_dict["hostname"], "LinuxGSM")
+        self.assertEqual(server_dict["bots"], "1")
+        self.assertEqual(server_dict["players"], "2")
+        self.assertEqual(server_dict["max_players"], "16")
+
+
+class TestRendering(unittest.TestCase):
+
+    def test_render_metrics(self):
+        text = render_metrics({"hostname": "LinuxGSM", "players": "2",
+                               "max_players": "16", "bots": "0",
+                               "FPS": 66.64, "Connects": 3.0})
+        lines = text.splitlines()
+        for line in ['srcds_up{hostname="LinuxGSM"} 1',
+                     'srcds_players{hostname="LinuxGSM"} 2',
+                     'srcds_maxplayers{hostname="LinuxGSM"} 16',
+                     'srcds_bots{hostname="LinuxGSM"} 0',
+                     'srcds_FPS{hostname="LinuxGSM"} 66.64',
+                     "# TYPE srcds_Connects counter",
+                     'srcds_Connects{hostname="LinuxGSM"} 3.0']:
+            self.assertIn(line, lines)
+        self.assertTrue(text.endswith("\n"))
+
+    def test_render_leaves_out_missing_metrics(self):
+        # Gmod does not list the bots
+        text = render_metrics({"hostname": "LinuxGSM", "players": "0",
+                               "max_players": "16"})
+        self.assertNotIn("srcds_bots", text)
+        self.assertNotIn("srcds_cpu", text)
+
+    def test_render_escapes_hostname(self):
+        text = render_metrics({"hostname": 'my "best" \\ server'})
+        self.assertIn('srcds_up{hostname="my \\"best\\" \\\\ server"} 1',
+                      text.splitlines())
@@ -0,0 +1,173 @@
+import asyncio
+import traceback
+import unittest
+from unittest import mock
+from aiorcon import RCONAuthenticationError
+from main import SRCDSExporter
+
+STATUS = ("hostname: LinuxGSM\n"
+          "players : 2 humans, 1 bots (16 max)\n"
+          "\n"
+          "# userid name uniqueid connected ping loss state adr\n")
+STATS = ("CPU    In_(KB/s)  Out_(KB/s)  Uptime  Map_changes  FPS      Players  Connects\n"
+         "0.00   0.00       0.00        8       0            66.64    0        0\n")
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.make_exporter()
+
+    def make_exporter(self, **kwargs):
+        self.exporter = SRCDSExporter(**kwargs)
+        self.fetches = 0
+
+        async def fetch(ip, port, password):
+            self.fetches += 1
+            await asyncio.sleep(0.01)
+            if password == "wrong":
+                raise ConnectionRefusedError()
+            if password == "unauthorized":
+                raise RCONAuthenticationError()
+            return STATUS, STATS
+
+        self.exporter._rcon_query = fetch
+
+    def run_scrapes(self, n, password="pw"):
+        async def run():
+            return await asyncio.gather(
+                    *(self.exporter._get_server_dict(
+                        "127.0.0.1", "27015", password) for _ in range(n)),
+                    return_exceptions=True)
+        return asyncio.run(run())
+
+    def test_concurrent_first_scrapes_are_batched(self):
+        answers = self.run_scrapes(10)
+        self.assertEqual(self.fetches, 1)
+        for answer in answers:
+            self.assertIs(answer, answers[0])
+        self.assertEqual(answers[0]["hostname"], "LinuxGSM")
+
+    def test_errors_reach_all_first_scrapes(self):
+        answers = self.run_scrapes(3, "wrong")
+        self.assertEqual(self.fetches, 1)
+        for answer in answers:
+            self.assertIsInstance(answer, ConnectionRefusedError)
+
+    def test_scrapes_are_answered_from_memory(self):
+        async def run():
+            first = await self.exporter._get_server_dict(
+                    "127.0.0.1", "27015", "pw")
+            second = await self.exporter._get_server_dict(
+                    "127.0.0.1", "27015", "pw")
+            self.assertEqual(len(self.exporter._pollers), 1)
+            return first, second
+
+        first, second = asyncio.run(run())
+        self.assertEqual(self.fetches, 1)
+        self.assertIs(first, second)
+        self.assertEqual(first["target"], "127.0.0.1:27015")
+        self.assertEqual(first["hostname"], "LinuxGSM")
+        self.assertEqual(first["players"], "2")
+        self.assertEqual(first["FPS"], 66.64)
+
+    def test_poll_errors_are_raised_on_scrape(self):
+        async def run():
+            for _ in range(2):
+                with self.assertRaises(ConnectionRefusedError):
+                    await self.exporter._get_server_dict(
+                            "127.0.0.1", "27015", "wrong")
+
+        asyncio.run(run())
+        # the failed poll stops the poller, so every scrape queries again
+        self.assertEqual(self.fetches, 2)
+
+    def test_poll_error_tracebacks_do_not_grow(self):
+        async def scrape():
+            try:
+                await self.exporter._get_server_dict(
+                        "127.0.0.1", "27015", "wrong")
+            except ConnectionRefusedError as e:
+                return len(traceback.extract_tb(e.__traceback__))
+
+        async def run():
+            # all of them raise the error of the same poll
+            return await asyncio.gather(*(scrape() for _ in range(3)))
+
+        lengths = asyncio.run(run())
+        self.assertEqual(len(set(lengths)), 1)
+
+    def test_poll_error_tracebacks_show_the_failed_query(self):
+        async def run():
+            try:
+                await self.exporter._get_server_dict(
+                        "127.0.0.1", "27015", "wrong")
+            except ConnectionRefusedError as e:
+                return [frame.name
+                        for frame in traceback.extract_tb(e.__traceback__)]
+
+        names = asyncio.run(run())
+        self.assertIn("_get_server_dict", names)
+        self.assertIn("_poll_once", names)
+        self.assertIn("fetch", names)
+
+    def test_errors_stop_polling(self):
+        for password, error in (("unauthorized", RCONAuthenticationError),
+                                ("wrong", ConnectionRefusedError)):
+            with self.subTest(error=error.__name__):
+                self.make_exporter(poll_interval=0.01)
+
+                async def run():
+                    for _ in range(2):
+                        with self.assertRaises(error):
+                            await self.exporter._get_server_dict(
+                                    "127.0.0.1", "27015", password)
+                        await asyncio.sleep(0.1)
+                        self.assertEqual(self.exporter._pollers, {})
+                        self.assertEqual(self.exporter._latest, {})
+                        self.assertEqual(self.exporter._scraped, {})
+
+                asyncio.run(run())
+                # one failed query per scrape, the poller does not retry
+                self.assertEqual(self.fetches, 2)
+
+    def test_poller_refreshes_the_result(self):
+        self.make_exporter(poll_interval=0.01)
+
+        async def run():
+            await self.exporter._get_server_dict("127.0.0.1", "27015", "pw")
+            await asyncio.sleep(0.1)
+
+        asyncio.run(run())
+        self.assertGreater(self.fetches, 1)
+
+    @mock.patch("main.POLL_IDLE_POLLS", 0)
+    def test_idle_poller_stops(self):
+        self.make_exporter(poll_interval=0.01)
+
+        async def run():
+            await self.exporter._get_server_dict("127.0.0.1", "27015", "pw")
+            await asyncio.sleep(0.05)
+
+        asyncio.run(run())
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self.exporter._pollers, {})
+        self.assertEqual(self.exporter._latest, {})
+        self.assertEqual(self.exporter._scraped, {})
+
+    @mock.patch("main.POLL_IDLE_POLLS", 0)
+    def test_cancelled_first_scrape_does_not_leak(self):
+        self.make_exporter(poll_interval=0.01)
+
+        async def run():
+            scrape = asyncio.ensure_future(self.exporter._get_server_dict(
+                    "127.0.0.1", "27015", "pw"))
+            await asyncio.sleep(0)
+            scrape.cancel()
+            await asyncio.sleep(0.05)
+
+        asyncio.run(run())
+        self.assertEqual(self.fetches, 1)
+        for state in (self.exporter._pollers, self.exporter._latest,
+                      self.exporter._scraped, self.exporter._pool):
+            self.assertEqual(state, {})